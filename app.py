@@ -1,7 +1,7 @@
 
 import os
 import uvicorn
-import pickle
+import numpy as np
 import psycopg2
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
@@ -9,7 +9,8 @@ from dotenv import load_dotenv
 from contextlib import asynccontextmanager
 
 # Import internal modules
-from src.indexer.reader import IndexReader
+from src.indexer.reader import IndexReader, lexicon_array_path
+from src.indexer.spimi import load_metadata, METADATA_FILE, DOC_IDS_FILE
 from src.ranking.bm25 import BM25Ranker
 from src.ranking.vector import VectorRanker
 from src.router import api_router, deps
@@ -26,26 +27,29 @@ db_conn = None
 async def lifespan(app: FastAPI):
     global index_reader, bm25_ranker, vector_ranker, db_conn
     
+    deps.configure_logging()
     print("Startup: Initializing Search Engines...")
     
     # 1. Initialize BM25
     try:
         index_file = "src/indexer/final_index.bin"
         lexicon_file = "src/indexer/lexicon.dat"
-        metadata_file = "src/indexer/output_blocks/metadata.pkl"
+        metadata_file = os.path.join("src/indexer/output_blocks", METADATA_FILE)
+        doc_lengths_file = "src/indexer/output_blocks/doc_lengths.npy"
+        doc_ids_file = os.path.join("src/indexer/output_blocks", DOC_IDS_FILE)
         
-        if os.path.exists(index_file) and os.path.exists(lexicon_file) and os.path.exists(metadata_file):
+        if all(os.path.exists(p) for p in (index_file, lexicon_file, lexicon_array_path(lexicon_file), metadata_file, doc_lengths_file, doc_ids_file)):
             print("Loading BM25 Indices...")
             # Load metadata
-            with open(metadata_file, 'rb') as f:
-                metadata = pickle.load(f)
+            metadata = load_metadata("src/indexer/output_blocks")
             
             # Init components
             index_reader = IndexReader(index_file, lexicon_file)
             bm25_ranker = BM25Ranker(
-                doc_lengths=metadata['doc_lengths'], 
+                doc_lengths=np.load(doc_lengths_file, mmap_mode='r'), 
                 avgdl=metadata['avgdl'], 
-                N=metadata['N']
+                N=metadata['N'],
+                doc_ids=np.load(doc_ids_file, mmap_mode='r')
             )
             
             # Inject into router deps
@@ -70,7 +74,11 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         print(f"Failed to load Vector Engine: {e}")
 
-    # 3. Initialize DB Connection Pool
+    # 3. Local sample products (fallback when the DB is unavailable)
+    deps.local_product_db = deps.load_local_products()
+    print(f"Loaded {len(deps.local_product_db)} local sample products.")
+
+    # 4. Initialize DB Connection Pool
     from psycopg2 import pool
     try:
         database_url = os.getenv("DATABASE_URL")
@@ -81,12 +89,22 @@ async def lifespan(app: FastAPI):
             # Normalize URL for CockroachDB compatibility
             normalized_url = database_url.replace("sslmode=verify-full", "sslmode=require").replace("&sslrootcert=system", "")
             
+            # minconn connections are opened (TLS + auth) right here, so the
+            # first requests don't pay the handshake. Each worker process
+            # opens its own pool, one after another, so the default is small
+            max_connections = deps.DB_MAX_CONNECTIONS
+            try:
+                warm_connections = int(os.getenv("DB_POOL_WARM", "2"))
+            except ValueError:
+                print("Warning: DB_POOL_WARM is not an integer, using 2.")
+                warm_connections = 2
+            min_connections = min(max(warm_connections, 1), max_connections)
             deps.db_pool = pool.ThreadedConnectionPool(
-                minconn=1,
-                maxconn=20, # Allow up to 20 concurrent DB connections
+                minconn=min_connections,
+                maxconn=max_connections,
                 dsn=normalized_url
             )
-            print("DB Connection Pool Ready.")
+            print(f"DB Connection Pool Ready ({min_connections} warm connections).")
         else:
             print("Warning: DATABASE_URL not found.")
     except Exception as e:
@@ -113,4 +131,13 @@ app.add_middleware(
 app.include_router(api_router, prefix="/api")
 
 if __name__ == "__main__":
-    uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=False)
+    if os.getenv("ENV") == "prod":
+        # uvloop + httptools (from uvicorn[standard]), one process per core;
+        # the index files are mmapped, so workers share their pages
+        uvicorn.run(
+            "app:app", host="0.0.0.0", port=8000,
+            workers=int(os.getenv("WEB_CONCURRENCY", "4")),
+            loop="uvloop", http="httptools", log_level="warning"
+        )
+    else:
+        uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=False)
@@ -1,21 +1,47 @@
 import argparse
 import time
-import pickle
+from functools import lru_cache
 import os
-import psycopg2
-from pyvi import ViTokenizer
+import numpy as np
+from scipy import sparse
+from psycopg2.pool import ThreadedConnectionPool
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
-from src.crawler.parser import get_product_generator
-from src.indexer.spimi import SPIMIIndexer
-from src.indexer.merging import merge_blocks
+from src.crawler.parser import get_product_generator, tokenize_query
+from src.indexer.spimi import SPIMIIndexer, load_metadata, METADATA_FILE, DOC_IDS_FILE
+from src.indexer.merging import merge_blocks, build_score_matrix
 from src.indexer.reader import IndexReader
-from src.ranking.bm25 import BM25Ranker
+from src.ranking.bm25 import BM25Ranker, EagerBM25Ranker
 
-def build_index():
+SCORE_MATRIX_FILE = "src/indexer/bm25_scores.npz"
+
+# Server-side prepared statement for result details, created once per pooled connection
+PREPARE_DETAILS = "PREPARE detail_q (INT8[]) AS SELECT id, name, price FROM raw_products WHERE id = ANY($1)"
+
+def fetch_details(db_pool, doc_ids, prepared):
+    """
+    Fetches name/price for doc_ids in one round-trip on a pooled connection.
+    prepared: set of connections that already hold the detail_q statement.
+    """
+    details_map = {}
+    conn = db_pool.getconn()
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            if conn not in prepared:
+                cur.execute(PREPARE_DETAILS)
+                prepared.add(conn)
+            cur.execute("EXECUTE detail_q (%s)", (list(doc_ids),))
+            for row in cur.fetchall():
+                details_map[row[0]] = {"name": row[1], "price": row[2]}
+    finally:
+        db_pool.putconn(conn)
+    return details_map
+
+def build_index(eager=False):
     print("Starting Indexing Process...")
     start_time = time.time()
     
@@ -34,33 +60,80 @@ def build_index():
     # 3. Merging
     print("Merging blocks...")
     merge_blocks(block_dir="src/indexer/output_blocks", output_file="src/indexer/final_index.bin", lexicon_file="src/indexer/lexicon.dat")
+
+    # 4. Precomputed BM25 score matrix, only needed by --eager search
+    if eager:
+        print("Building score matrix...")
+        build_score_matrix(index_file="src/indexer/final_index.bin", lexicon_file="src/indexer/lexicon.dat", block_dir="src/indexer/output_blocks", output_file=SCORE_MATRIX_FILE)
+    elif os.path.exists(SCORE_MATRIX_FILE):
+        # A matrix from an earlier build no longer matches the new index
+        os.remove(SCORE_MATRIX_FILE)
     
     print(f"Indexing completed in {time.time() - start_time:.2f} seconds.")
 
-def search_loop():
+def search_loop(eager=False):
     print("Loading Search Engine...")
     
     # Load Metadata
-    meta_path = os.path.join("src/indexer/output_blocks", "metadata.pkl")
+    meta_path = os.path.join("src/indexer/output_blocks", METADATA_FILE)
     if not os.path.exists(meta_path):
         print("Metadata not found. Please run indexing first.")
         return
         
-    with open(meta_path, 'rb') as f:
-        metadata = pickle.load(f)
+    metadata = load_metadata("src/indexer/output_blocks")
         
     N = metadata['N']
     avgdl = metadata['avgdl']
-    doc_lengths = metadata['doc_lengths']
+    doc_lengths = np.load(os.path.join("src/indexer/output_blocks", "doc_lengths.npy"), mmap_mode="r")
+    doc_ids = np.load(os.path.join("src/indexer/output_blocks", DOC_IDS_FILE), mmap_mode="r")
 
     # Initialize Reader and Ranker
     reader = IndexReader(index_file="src/indexer/final_index.bin", lexicon_file="src/indexer/lexicon.dat")
-    ranker = BM25Ranker(doc_lengths=doc_lengths, avgdl=avgdl, N=N)
+    ranker = BM25Ranker(doc_lengths=doc_lengths, avgdl=avgdl, N=N, doc_ids=doc_ids)
+    # Precomputed BM25 scores are opt-in: the whole CSR matrix is loaded
+    # into RAM, while query-time scoring only touches the mapped postings
+    eager_ranker = None
+    if eager:
+        if not os.path.exists(SCORE_MATRIX_FILE):
+            print("Score matrix not found. Run --index --eager to build it.")
+            return
+        eager_ranker = EagerBM25Ranker(sparse.load_npz(SCORE_MATRIX_FILE), reader.trie, doc_ids=doc_ids)
     
-    # DB connection for details
+    # DB connection pool for details, opened once for the whole session
     db_url = os.getenv("DATABASE_URL")
+    db_pool = None
+    prepared = set()
     if not db_url:
         print("DATABASE_URL not found. Result details might be limited.")
+    else:
+        try:
+            db_pool = ThreadedConnectionPool(1, 8, db_url)
+        except Exception as e:
+            print(f"Error connecting to database: {e}")
+
+    @lru_cache(maxsize=1024)
+    def search(query_norm):
+        """
+        Tokenizes and ranks a normalized query, returning ((doc_id, score), ...).
+        Cached per session: the index does not change until the next --index run.
+        """
+        # 1. Preprocessing
+        # Simple whitespace tokenize + lowercase to match parser logic
+        #query_tokens = query.lower().split()
+        query_tokens = tokenize_query(query_norm)
+        if eager_ranker:
+            # 2-3. Ranking straight from the precomputed score matrix
+            return tuple(eager_ranker.rank(query_tokens, top_k=10))
+
+        # 2. Get Postings as (docnos, tfs) arrays, with their lexicon bounds
+        candidate_postings, max_tfs, idfs = reader.get_query_postings(query_tokens)
+        
+        if not candidate_postings:
+            return ()
+            
+        # 3. Ranking
+        # returns list of (doc_id, score)
+        return tuple(ranker.rank(query_tokens, candidate_postings, top_k=10, max_tfs=max_tfs, idfs=idfs))
 
     print("Search Engine Ready!")
     
@@ -72,25 +145,7 @@ def search_loop():
             continue
             
         start_search = time.time()
-        
-        # 1. Preprocessing
-        # Simple whitespace tokenize + lowercase to match parser logic
-        #query_tokens = query.lower().split()
-        query_tokens = ViTokenizer.tokenize(query.lower()).split()
-        # 2. Get Postings
-        candidate_postings = {}
-        for token in query_tokens:
-            postings = reader.get_postings(token)
-            if postings:
-                candidate_postings[token] = postings
-        
-        if not candidate_postings:
-            print("No results found.")
-            continue
-            
-        # 3. Ranking
-        # returns list of (doc_id, score)
-        top_results = ranker.rank(query_tokens, candidate_postings, top_k=10)
+        top_results = search(query.lower())
         
         search_time = time.time() - start_search
         print(f"Found {len(top_results)} results in {search_time:.4f}s")
@@ -105,43 +160,41 @@ def search_loop():
             doc_ids = [res[0] for res in top_results]
             details_map = {}
             
-            if db_url:
+            if db_pool:
                 try:
-                    conn = psycopg2.connect(db_url)
-                    with conn.cursor() as cur:
-                        # Use ANY(%s) to fetch all docs at once
-                        cur.execute("SELECT id, name, price FROM raw_products WHERE id = ANY(%s)", (doc_ids,))
-                        for row in cur.fetchall():
-                            details_map[str(row[0])] = {"name": row[1], "price": row[2]}
-                    conn.close()
+                    details_map = fetch_details(db_pool, doc_ids, prepared)
                 except Exception as e:
                     print(f"Error fetching details: {e}")
 
             for rank, (doc_id, score) in enumerate(top_results, 1):
-                product = details_map.get(str(doc_id), {})
+                product = details_map.get(doc_id, {})
                 name = product.get("name", "Unknown (DB lookup failed)")
                 price = product.get("price", "N/A")
                 
                 print(f"{rank}. [ID: {doc_id}] {name} - Price: {price} (Score: {score:.4f})")
+
+    if db_pool:
+        db_pool.closeall()
         
 
 def main():
     parser = argparse.ArgumentParser(description="Search Engine")
     parser.add_argument('--index', action='store_true', help='Run Indexing Pipeline')
     parser.add_argument('--search', action='store_true', help='Run Search Console')
+    parser.add_argument('--eager', action='store_true', help='Precompute BM25 scores when indexing and rank from them when searching (loads the score matrix into RAM)')
     
     args = parser.parse_args()
     
     if args.index:
-        build_index()
+        build_index(eager=args.eager)
     elif args.search:
-        search_loop()
+        search_loop(eager=args.eager)
     else:
         if os.path.exists("src/indexer/final_index.bin"):
-             search_loop()
+             search_loop(eager=args.eager)
         else:
              print("Index not found. Run with --index to build.")
-             build_index() # Or just run it.
+             build_index(eager=args.eager) # Or just run it.
 
 if __name__ == "__main__":
     main()
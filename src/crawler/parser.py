@@ -1,16 +1,48 @@
 import os
-import psycopg2
+import multiprocessing
+from collections import deque
+from functools import lru_cache
 from pyvi import ViTokenizer
-from dotenv import load_dotenv
 
-load_dotenv()
+# Rows per FETCH from the server-side cursor; each batch is one round-trip
+FETCH_BATCH_SIZE = 10000
+
+@lru_cache(maxsize=4096)
+def tokenize_query(query):
+    """
+    Word-segments a (lowercased) query with Pyvi, matching the index tokens.
+    Cached since repeated queries would otherwise re-run the tokenizer.
+    """
+    return tuple(ViTokenizer.tokenize(query).split())
+
+def tokenize_rows(rows):
+    """
+    Pool worker: word-segments a batch of (id, name_normalized) rows.
+    Returns [(doc_id, tokens)] in the same order.
+    """
+    tokenized = []
+    for row in rows:
+        doc_id = int(row[0])
+        name_normalized = row[1]
+        
+        if name_normalized:
+            # ViTokenizer.tokenize sẽ nối từ ghép bằng gạch dưới
+            tokenized.append((doc_id, ViTokenizer.tokenize(name_normalized).split()))
+    return tokenized
 
 def get_product_generator():
     """
     Yields product data line-by-line from the Postgres/CockroachDB database.
     Queries 'external_id' and 'name_normalized' from 'raw_products'.
-    Normalize 'name_normalized' using Pyvi.
+    Normalize 'name_normalized' using Pyvi, one batch per worker process;
+    batches are yielded in fetch order with a bounded number in flight.
     """
+    # Only indexing needs the DB; importing this module for tokenize_query
+    # shouldn't require psycopg2 or read .env
+    import psycopg2
+    from dotenv import load_dotenv
+
+    load_dotenv()
     db_url = os.getenv("DATABASE_URL")
     if not db_url:
         print("Error: DATABASE_URL not found in environment variables.")
@@ -23,22 +55,25 @@ def get_product_generator():
         # Use server-side cursor (named cursor) to stream results
         # 'product_cursor' is the name of the cursor on the server
         with conn.cursor(name='product_cursor') as cursor:
-            cursor.execute("SELECT id, name_normalized FROM raw_products")
+            # Empty names are skipped by the server instead of shipped and dropped here
+            cursor.execute("SELECT id, name_normalized FROM raw_products WHERE name_normalized IS NOT NULL AND name_normalized != ''")
             
-            while True:
-                # Fetch small batches to keep RAM usage low
-                rows = cursor.fetchmany(size=1000)
-                if not rows:
-                    break
+            workers = os.cpu_count() or 1
+            with multiprocessing.Pool(processes=workers) as pool:
+                pending = deque()
+                while True:
+                    # Fetch in batches: few round-trips, bounded RAM
+                    rows = cursor.fetchmany(size=FETCH_BATCH_SIZE)
+                    if not rows:
+                        break
+                    pending.append(pool.apply_async(tokenize_rows, (rows,)))
                     
-                for row in rows:
-                    doc_id = str(row[0])
-                    name_normalized = row[1]
-                    
-                    if name_normalized:
-                        # ViTokenizer.tokenize sẽ nối từ ghép bằng gạch dưới
-                        tokenized_name = ViTokenizer.tokenize(name_normalized).split()
-                        yield doc_id, tokenized_name
+                    # Keep at most two batches per worker in flight
+                    if len(pending) >= 2 * workers:
+                        yield from pending.popleft().get()
+                        
+                while pending:
+                    yield from pending.popleft().get()
                         
     except Exception as e:
         print(f"Database error: {e}")
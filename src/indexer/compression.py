@@ -0,0 +1,60 @@
+import numpy as np
+
+# Deltas per bit-packed block; each block gets its own bit width
+BLOCK_SIZE = 128
+
+def pack_bits(values, width):
+    """Packs non-negative ints into `width` bits each, little-endian bit order."""
+    if width == 0:
+        return b''
+    bits = ((values[:, None] >> np.arange(width, dtype=np.int64)) & 1).astype(np.uint8)
+    return np.packbits(bits.ravel(), bitorder='little').tobytes()
+
+def unpack_bits(data, count, width):
+    """Inverse of pack_bits for `count` values, returning int64."""
+    if width == 0:
+        return np.zeros(count, dtype=np.int64)
+    bits = np.unpackbits(data, count=count * width, bitorder='little').reshape(count, width)
+    return (bits.astype(np.int64) << np.arange(width, dtype=np.int64)).sum(axis=1)
+
+def encode_doc_ids(doc_ids):
+    """
+    Delta encodes an ascending docno list and bit-packs the deltas in blocks
+    of BLOCK_SIZE: one width byte per block, followed by the packed blocks.
+    """
+    deltas = np.diff(np.asarray(doc_ids, dtype=np.int64), prepend=0)
+    blocks = [deltas[i:i + BLOCK_SIZE] for i in range(0, len(deltas), BLOCK_SIZE)]
+    widths = [int(block.max()).bit_length() for block in blocks]
+    return bytes(widths) + b''.join(pack_bits(block, width) for block, width in zip(blocks, widths))
+
+def decode_doc_ids(buf, count):
+    """
+    Inverse of encode_doc_ids, returning int32 docnos. Full blocks are
+    unpacked together per distinct bit width, so the Python loop runs once
+    per width (at most 32) rather than once per block.
+    """
+    data = np.frombuffer(buf, dtype=np.uint8)
+    num_blocks = -(-count // BLOCK_SIZE)
+    widths = data[:num_blocks].astype(np.int64)
+    sizes = np.full(num_blocks, BLOCK_SIZE, dtype=np.int64)
+    if num_blocks:
+        sizes[-1] = count - (num_blocks - 1) * BLOCK_SIZE
+    nbytes = (sizes * widths + 7) // 8
+    starts = num_blocks + np.concatenate(([0], np.cumsum(nbytes)[:-1]))
+
+    deltas = np.zeros((num_blocks, BLOCK_SIZE), dtype=np.int64)
+    full = sizes == BLOCK_SIZE
+    for width in np.unique(widths[full]).tolist():
+        if width == 0:
+            continue
+        blocks = np.flatnonzero(full & (widths == width))
+        # A full block is exactly BLOCK_SIZE * width / 8 = 16 * width bytes
+        packed = data[starts[blocks, None] + np.arange(BLOCK_SIZE * width // 8)]
+        bits = np.unpackbits(packed, axis=1, bitorder='little').reshape(len(blocks), BLOCK_SIZE, width)
+        deltas[blocks] = bits.astype(np.int64) @ (1 << np.arange(width, dtype=np.int64))
+    if num_blocks and not full[-1]:
+        last = num_blocks - 1
+        deltas[last, :sizes[last]] = unpack_bits(
+            data[starts[last]:starts[last] + nbytes[last]], int(sizes[last]), int(widths[last])
+        )
+    return np.cumsum(deltas.ravel()[:count]).astype(np.int32)
@@ -1,84 +1,224 @@
-import pickle
 import os
+import re
 import heapq
+import struct
+import shutil
+import multiprocessing
+from bisect import bisect_left
 from contextlib import ExitStack
+import numpy as np
+import msgspec
+import marisa_trie
+from scipy import sparse
 
-def merge_blocks(block_dir="src/indexer/output_blocks", output_file="src/indexer/final_index.bin", lexicon_file="src/indexer/lexicon.dat"):
+from src.indexer.compression import encode_doc_ids
+from src.indexer.reader import IndexReader, LEXICON_DTYPE, lexicon_array_path
+from src.indexer.spimi import load_metadata, skip_index_path
+from src.ranking.bm25 import BM25Ranker, bm25_idf
+
+# Largest tf stored in a posting; tfs are kept as one byte each
+MAX_TF = 255
+
+# Output file buffer, and how many bytes of encoded terms are batched per write()
+WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+WRITE_CHUNK_SIZE = 64 * 1024
+
+def encode_postings(parts):
     """
-    Performs K-Way Merge on block files.
+    Serializes a term's (docnos, tfs) int32 byte parts (in docno order) as
+    raw tfs (uint8, clamped to MAX_TF) followed by the delta + bit-packed
+    compressed docnos; the tfs can be mapped straight out of the index file.
+    Returns (bytes, df, max_tf).
     """
-    block_files = sorted([os.path.join(block_dir, f) for f in os.listdir(block_dir) if f.endswith('.bin')])
-    if not block_files:
-        print("No blocks to merge.")
+    doc_ids = np.frombuffer(b''.join(docnos for docnos, _ in parts), dtype=np.int32)
+    tfs = np.minimum(np.frombuffer(b''.join(tfs for _, tfs in parts), dtype=np.int32), MAX_TF)
+    return tfs.astype(np.uint8).tobytes() + encode_doc_ids(doc_ids), len(doc_ids), int(tfs.max())
+
+def read_block(f, decoder, lo=None, hi=None):
+    """
+    Yields the (term, docnos, tfs) records of a block file one at a time,
+    only those with lo <= term < hi when bounds are given.
+    """
+    while True:
+        header = f.read(4)
+        if not header:
+            return
+        n, = struct.unpack(">I", header)
+        record = decoder.decode(f.read(n))
+        if hi is not None and record[0] >= hi:
+            return
+        if lo is None or record[0] >= lo:
+            yield record
+
+def load_skip_index(block_file):
+    """Sampled [(term, offset)] of a block, empty if it has no skip index."""
+    path = skip_index_path(block_file)
+    if not os.path.exists(path):
+        return []
+    with open(path, 'rb') as f:
+        return msgspec.msgpack.decode(f.read())
+
+def seek_block(f, block_file, lo):
+    """Moves f to the last sampled record before term lo."""
+    if lo is None:
         return
+    skips = load_skip_index(block_file)
+    i = bisect_left([term for term, _ in skips], lo) - 1
+    if i >= 0:
+        f.seek(skips[i][1])
+
+def term_ranges(block_files, num_ranges):
+    """
+    Splits the term space into up to num_ranges contiguous [lo, hi) ranges
+    (None = unbounded) of similar size, using the blocks' sampled terms.
+    """
+    samples = sorted({term for fn in block_files for term, _ in load_skip_index(fn)})
+    if not samples:
+        return [(None, None)]
+    # samples[0] is the smallest term of all, so it cannot end a range
+    bounds = sorted({samples[len(samples) * i // num_ranges] for i in range(1, num_ranges)} - {samples[0]})
+    return list(zip([None] + bounds, bounds + [None]))
 
+def merge_range(block_files, lo, hi, output_file):
+    """
+    K-way merges the lo <= term < hi records of every block into
+    output_file. Returns (terms, records) with (offset, length, df, max_tf)
+    records whose offsets are relative to output_file.
+    """
     # Use ExitStack to manage multiple open files
     with ExitStack() as stack:
         files = [stack.enter_context(open(fn, 'rb')) for fn in block_files]
         
-        print("Loading blocks for merging...")
-        iterators = []
-        for f in files:
-            try:
-                data = pickle.load(f)
-                iterators.append(iter(data)) 
-            except EOFError:
-                continue
+        # Records are streamed, so only one term per block is held in memory
+        decoder = msgspec.msgpack.Decoder()
+        for f, fn in zip(files, block_files):
+            seek_block(f, fn, lo)
+        iterators = [read_block(f, decoder, lo, hi) for f in files]
 
+        # Heap of (term, block_idx, docnos, tfs); (term, block_idx) is unique,
+        # so tuples compare in C without reaching the arrays, and equal terms
+        # come out in block order, keeping docnos ascending across blocks
         heap = []
         for i, it in enumerate(iterators):
-            try:
-                term, postings = next(it)
-                heapq.heappush(heap, (term, i, postings))
-            except StopIteration:
-                pass
+            record = next(it, None)
+            if record is not None:
+                heap.append((record[0], i, record[1], record[2]))
+        heapq.heapify(heap)
         
-        lexicon = {}
+        terms, records = [], []
         offset = 0
         
-        with open(output_file, 'wb') as out_f:
-            current_term = None
-            current_postings = {}
-            
+        with open(output_file, 'wb', buffering=WRITE_BUFFER_SIZE) as out_f:
+            chunk = bytearray()
             while heap:
-                term, idx, postings = heapq.heappop(heap)
+                term = heap[0][0]
                 
-                if current_term is None:
-                    current_term = term
-                    current_postings = postings
-                elif term == current_term:
-                    current_postings.update(postings)
-                else:
-                    data_bytes = pickle.dumps(current_postings)
-                    length = len(data_bytes)
-                    
-                    # Update lexicon
-                    lexicon[current_term] = {'offset': offset, 'length': length}
-                    
-                    # Write to file
-                    out_f.write(data_bytes)
-                    offset += length
-                    
-                    # Start new term
-                    current_term = term
-                    current_postings = postings
+                # Drain every block's postings for this term; blocks hold
+                # disjoint docnos, so the parts are simply concatenated
+                parts = []
+                while heap and heap[0][0] == term:
+                    _, i, docnos, tfs = heap[0]
+                    parts.append((docnos, tfs))
+                    record = next(iterators[i], None)
+                    if record is None:
+                        heapq.heappop(heap)
+                    else:
+                        heapq.heapreplace(heap, (record[0], i, record[1], record[2]))
                 
-                # Push next from same iterator
-                try:
-                    next_term, next_postings = next(iterators[idx])
-                    heapq.heappush(heap, (next_term, idx, next_postings))
-                except StopIteration:
-                    pass
-            
-            # Write global last term
-            if current_term is not None:
-                data_bytes = pickle.dumps(current_postings)
+                data_bytes, df, max_tf = encode_postings(parts)
                 length = len(data_bytes)
-                lexicon[current_term] = {'offset': offset, 'length': length}
-                out_f.write(data_bytes)
+                
+                # Update lexicon
+                terms.append(term)
+                records.append((offset, length, df, max_tf))
+                
+                # Write to file in chunks of several terms
+                chunk += data_bytes
+                offset += length
+                if len(chunk) >= WRITE_CHUNK_SIZE:
+                    out_f.write(chunk)
+                    chunk.clear()
+            out_f.write(chunk)
+    return terms, records
+
+def merge_blocks(block_dir="src/indexer/output_blocks", output_file="src/indexer/final_index.bin", lexicon_file="src/indexer/lexicon.dat", workers=None):
+    """
+    Performs K-Way Merge on block files. The term space is split into
+    contiguous ranges merged in parallel processes, whose outputs are then
+    concatenated into the final index.
+    """
+    # Numeric block order keeps each merged posting list sorted by docno;
+    # anything in block_dir not named block_N.bin is left alone
+    numbered = []
+    for f in os.listdir(block_dir):
+        match = re.fullmatch(r'block_(\d+)\.bin', f)
+        if match:
+            numbered.append((int(match.group(1)), os.path.join(block_dir, f)))
+    block_files = [fn for _, fn in sorted(numbered)]
+    if not block_files:
+        print("No blocks to merge.")
+        return
+
+    workers = workers or os.cpu_count() or 1
+    ranges = term_ranges(block_files, workers) if workers > 1 else [(None, None)]
+    if len(ranges) == 1:
+        results = [merge_range(block_files, None, None, output_file)]
+    else:
+        print(f"Merging {len(ranges)} term ranges in parallel...")
+        shard_files = [f"{output_file}.part{i}" for i in range(len(ranges))]
+        with multiprocessing.Pool(processes=len(ranges)) as pool:
+            results = pool.starmap(merge_range, [(block_files, lo, hi, shard) for (lo, hi), shard in zip(ranges, shard_files)])
+        with open(output_file, 'wb') as out_f:
+            for shard in shard_files:
+                with open(shard, 'rb') as f:
+                    shutil.copyfileobj(f, out_f, WRITE_BUFFER_SIZE)
+                os.remove(shard)
+
+    # Shift each range's offsets by the bytes of the ranges before it
+    terms, records = [], []
+    base = 0
+    for range_terms, range_records in results:
+        terms.extend(range_terms)
+        records.extend((offset + base, length, df, max_tf) for offset, length, df, max_tf in range_records)
+        if range_records:
+            base += range_records[-1][0] + range_records[-1][1]
     
-    # Save lexicon
-    with open(lexicon_file, 'wb') as f:
-        pickle.dump(lexicon, f)
+    # Save lexicon: a term -> term id trie, and the records ordered by term id,
+    # with each term's idf computed once here instead of on every query
+    trie = marisa_trie.Trie(terms)
+    lexicon = np.empty(len(terms), dtype=LEXICON_DTYPE)
+    term_ids = np.fromiter((trie[term] for term in terms), dtype=np.int64, count=len(terms))
+    lexicon[term_ids] = np.fromiter((record + (0.0,) for record in records), dtype=LEXICON_DTYPE, count=len(records))
+    lexicon['idf'] = bm25_idf(load_metadata(block_dir)['N'], lexicon['df'])
+    trie.save(lexicon_file)
+    np.save(lexicon_array_path(lexicon_file), lexicon)
     
     print(f"Merged complete. Index saved to {output_file}, Lexicon to {lexicon_file}")
+
+def build_score_matrix(index_file="src/indexer/final_index.bin", lexicon_file="src/indexer/lexicon.dat", block_dir="src/indexer/output_blocks", output_file="src/indexer/bm25_scores.npz"):
+    """
+    Precomputes the BM25 score of every posting into a (terms x docs) CSR
+    matrix whose rows are the lexicon term ids, so a query becomes a
+    sparse row sum instead of scoring postings at query time.
+    """
+    metadata = load_metadata(block_dir)
+    doc_lengths = np.load(os.path.join(block_dir, "doc_lengths.npy"))
+    ranker = BM25Ranker(doc_lengths=doc_lengths, avgdl=metadata['avgdl'], N=metadata['N'])
+
+    reader = IndexReader(index_file, lexicon_file)
+    num_terms = len(reader.lexicon)
+    indptr = np.zeros(num_terms + 1, dtype=np.int64)
+    data, indices = [np.empty(0, dtype=np.float32)], [np.empty(0, dtype=np.int32)]
+    for term_id in range(num_terms):
+        doc_ids, tfs = reader.read_postings(term_id)
+        data.append(ranker.term_scores(doc_ids, tfs))
+        indices.append(doc_ids)
+        indptr[term_id + 1] = len(doc_ids)
+    reader.close()
+
+    matrix = sparse.csr_matrix(
+        (np.concatenate(data), np.concatenate(indices), np.cumsum(indptr)),
+        shape=(num_terms, metadata['N'])
+    )
+    sparse.save_npz(output_file, matrix, compressed=False)
+    print(f"Score matrix saved to {output_file} ({matrix.nnz} postings)")
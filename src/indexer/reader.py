@@ -1,53 +1,111 @@
-import pickle
 import os
+import mmap
+from functools import lru_cache
+import numpy as np
+import marisa_trie
+
+from src.indexer.compression import decode_doc_ids
+
+EMPTY_POSTINGS = (np.empty(0, dtype=np.int32), np.empty(0, dtype=np.uint8))
+
+# Decoded posting lists kept per reader, keyed by term id
+POSTINGS_CACHE_SIZE = 65536
+
+# One lexicon record per term id (the term's id in the marisa trie)
+LEXICON_DTYPE = np.dtype([('offset', np.int64), ('length', np.int32), ('df', np.int32), ('max_tf', np.uint8), ('idf', np.float32)])
+
+def lexicon_array_path(lexicon_file):
+    """Path of the per-term-id record array stored next to the lexicon trie."""
+    return os.path.splitext(lexicon_file)[0] + ".npy"
 
 class IndexReader:
     def __init__(self, index_file="src/indexer/final_index.bin", lexicon_file="src/indexer/lexicon.dat"):
         self.index_path = index_file
         self.lexicon_path = lexicon_file
-        self.lexicon = {}
+        self.trie = marisa_trie.Trie()  # term -> term id
+        self.lexicon = np.empty(0, dtype=LEXICON_DTYPE)  # term id -> record
         self.file_handle = None
+        self.mm = None
+        # Per-instance LRU, so the cache goes away with the reader
+        self.get_postings_by_id = lru_cache(maxsize=POSTINGS_CACHE_SIZE)(self.read_postings)
         self.load_lexicon()
         self.open_file()
 
     def load_lexicon(self):
-        """Loads the lexicon (term -> offset, length) into RAM."""
+        """Maps the term trie and the term id -> (offset, length, df, max_tf, idf) records."""
         if not os.path.exists(self.lexicon_path):
             print(f"Lexicon file {self.lexicon_path} not found.")
             return
         
-        with open(self.lexicon_path, 'rb') as f:
-            self.lexicon = pickle.load(f)
+        self.trie.mmap(self.lexicon_path)
+        self.lexicon = np.load(lexicon_array_path(self.lexicon_path), mmap_mode='r')
             
     def open_file(self):
-        """Opens the binary index file in read-binary mode."""
+        """Opens the binary index file and maps it read-only into memory."""
         if os.path.exists(self.index_path):
             self.file_handle = open(self.index_path, 'rb')
+            if os.path.getsize(self.index_path) > 0:
+                self.mm = mmap.mmap(self.file_handle.fileno(), 0, access=mmap.ACCESS_READ)
+                # Lookups jump between terms, so readahead only pulls in unused pages
+                if hasattr(mmap, "MADV_RANDOM"):
+                    self.mm.madvise(mmap.MADV_RANDOM)
         else:
             print(f"Index file {self.index_path} not found.")
             
     def close(self):
+        # Postings handed out are views into the map, so it is released
+        # (not force-closed) once the last view is gone
+        self.mm = None
         if self.file_handle:
             self.file_handle.close()
 
     def get_postings(self, term):
         """
-        Retrieves postings for a term using seek() and read().
-        Returns {doc_id: tf} or empty dict if not found.
+        Retrieves postings for a term from the mapped index: tfs are a
+        zero-copy view, docnos are decoded from their compressed deltas.
+        Returns parallel read-only arrays (docnos: int32, tfs: uint8), empty
+        if not found. Recently used terms are served from an LRU cache.
         """
-        if term not in self.lexicon:
-            return {}
-        
-        meta = self.lexicon[term]
-        offset = meta['offset']
-        length = meta['length']
-        
-        if self.file_handle:
-            self.file_handle.seek(offset)
-            data_bytes = self.file_handle.read(length)
-            return pickle.loads(data_bytes)
+        term_id = self.trie.get(term)
+        if term_id is None:
+            return EMPTY_POSTINGS
+        return self.get_postings_by_id(term_id)
+
+    def get_query_postings(self, terms):
+        """
+        Postings, max_tf and idf of each query term with a non-empty posting
+        list, looking every term up in the trie once. Returns the
+        (candidate_postings, max_tfs, idfs) dicts BM25Ranker.rank takes.
+        """
+        candidate_postings, max_tfs, idfs = {}, {}, {}
+        for term in terms:
+            term_id = self.trie.get(term)
+            if term_id is None:
+                continue
+            postings = self.get_postings_by_id(term_id)
+            if not len(postings[0]):
+                continue
+            record = self.lexicon[term_id]
+            candidate_postings[term] = postings
+            max_tfs[term] = int(record['max_tf'])
+            idfs[term] = float(record['idf'])
+        return candidate_postings, max_tfs, idfs
+
+    def read_postings(self, term_id):
+        """
+        Decodes a term id's postings from the map, bypassing the cache
+        (get_postings_by_id is the cached version). The arrays are made
+        read-only since cached copies are shared between queries.
+        """
+        if self.mm is None:
+            return EMPTY_POSTINGS
         
-        return {}
+        offset, length, df, _, _ = self.lexicon[term_id].tolist()
+        tfs = np.frombuffer(self.mm, dtype=np.uint8, count=df, offset=offset)
+        doc_bytes = np.frombuffer(self.mm, dtype=np.uint8, count=length - df, offset=offset + df)
+        doc_ids = decode_doc_ids(doc_bytes, df)
+        doc_ids.setflags(write=False)
+        return doc_ids, tfs
 
     def __del__(self):
         self.close()
@@ -1,18 +1,50 @@
-import pickle
 import os
 import json
-from collections import defaultdict
+import struct
+from array import array
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import msgspec
+
+METADATA_FILE = "metadata.msgpack"
+DOC_IDS_FILE = "doc_ids.npy"
+
+# Approximate RAM per dictionary entry, used to decide when to flush a block:
+# a new term costs its str plus the dict slot, the [docnos, tfs] list and two
+# array objects; a posting adds one int32 to each array (with growth slack)
+TERM_BYTES = 300
+POSTING_BYTES = 9
+
+# Every SKIP_INTERVAL-th record of a block is listed in its skip index
+SKIP_INTERVAL = 256
+
+def skip_index_path(block_filename):
+    """Sidecar file listing sampled (term, byte offset) pairs of a block."""
+    return os.path.splitext(block_filename)[0] + ".idx"
+
+def load_metadata(output_dir="src/indexer/output_blocks"):
+    """Reads the corpus metadata written by SPIMIIndexer.save_metadata."""
+    with open(os.path.join(output_dir, METADATA_FILE), 'rb') as f:
+        return msgspec.msgpack.decode(f.read())
+
+def _new_postings():
+    """Parallel (docnos, tfs) int32 arrays for one term."""
+    return [array('i'), array('i')]
 
 class SPIMIIndexer:
     def __init__(self, block_size_limit_mb=50, output_dir="src/indexer/output_blocks"):
         self.block_size_limit = block_size_limit_mb * 1024 * 1024
         self.output_dir = output_dir
-        self.dictionary = defaultdict(dict) # {term: {doc_id: tf}}
+        self.dictionary = defaultdict(_new_postings) # {term: [docnos, tfs]}
         self.block_count = 0
-        self.doc_lengths = {}
+        self.doc_ids = array('q')      # docno -> external (int) doc_id
+        self.doc_lengths = array('i')  # docno -> document length
         self.total_length = 0
         self.doc_count = 0
         self._estimated_size = 0  # incremental byte estimate of dictionary content
+        self.writer_pool = ThreadPoolExecutor(max_workers=1)  # serializes blocks off the indexing thread
+        self.pending = None  # future of the block being written
 
         if not os.path.exists(self.output_dir):
             os.makedirs(self.output_dir)
@@ -20,22 +52,25 @@ class SPIMIIndexer:
     def run_indexing(self, doc_generator):
         """
         Consumes (doc_id, tokens) from generator and builds index.
+        Documents are numbered 0..N-1 in arrival order; postings store that
+        compact docno so the ranker can index dense arrays with it.
         """
         for doc_id, tokens in doc_generator:
+            docno = self.doc_count
             doc_len = len(tokens)
-            self.doc_lengths[doc_id] = doc_len
+            self.doc_ids.append(doc_id)
+            self.doc_lengths.append(doc_len)
             self.total_length += doc_len
             self.doc_count += 1
             
-            for term in tokens:
-                is_new_term = term not in self.dictionary
-                is_new_posting = doc_id not in self.dictionary[term]
-                self.dictionary[term][doc_id] = self.dictionary[term].get(doc_id, 0) + 1
-
-                if is_new_term:
-                    self._estimated_size += len(term.encode())
-                if is_new_posting:
-                    self._estimated_size += 16
+            # Count the document's tfs in C, then add one posting per distinct term
+            for term, tf in Counter(tokens).items():
+                if term not in self.dictionary:
+                    self._estimated_size += TERM_BYTES + len(term.encode())
+                docnos, tfs = self.dictionary[term]
+                docnos.append(docno)
+                tfs.append(tf)
+                self._estimated_size += POSTING_BYTES
 
             if self._estimated_size >= self.block_size_limit:
                 self.write_block()
@@ -43,6 +78,11 @@ class SPIMIIndexer:
         # Write remaining data
         if self.dictionary:
             self.write_block()
+        if self.pending:
+            self.pending.result()
+            self.pending = None
+        # Stop the writer thread so it isn't alive when merging forks workers
+        self.writer_pool.shutdown(wait=True)
             
         # Save Metadata
         self.save_metadata()
@@ -52,32 +92,59 @@ class SPIMIIndexer:
         metadata = {
             'N': self.doc_count,
             'avgdl': avgdl,
-            'total_length': self.total_length,
-            'doc_lengths': self.doc_lengths
+            'total_length': self.total_length
         }
-        meta_path = os.path.join(self.output_dir, "metadata.pkl")
+        meta_path = os.path.join(self.output_dir, METADATA_FILE)
         with open(meta_path, 'wb') as f:
-            pickle.dump(metadata, f)
+            f.write(msgspec.msgpack.encode(metadata))
+        # Lengths and ids are stored as flat arrays so search can mmap them
+        lengths_path = os.path.join(self.output_dir, "doc_lengths.npy")
+        np.save(lengths_path, np.frombuffer(self.doc_lengths, dtype=np.int32))
+        np.save(os.path.join(self.output_dir, DOC_IDS_FILE), np.frombuffer(self.doc_ids, dtype=np.int64))
         print(f"Metadata saved to {meta_path} (N={self.doc_count}, avgdl={avgdl:.2f})")
 
     def write_block(self):
         """
-        Sorts terms and writes current dictionary to a binary block file.
+        Hands the current dictionary to the writer thread and starts a new
+        one, so indexing continues while the block is sorted and written.
+        At most one block is in flight: the previous write is awaited first.
         """
         self.block_count += 1
         block_filename = os.path.join(self.output_dir, f"block_{self.block_count}.bin")
+        dictionary = self.dictionary
+        self.dictionary = defaultdict(_new_postings)
+        self._estimated_size = 0
+        
+        if self.pending:
+            self.pending.result()
+        self.pending = self.writer_pool.submit(self._serialize_block, dictionary, block_filename)
+
+    @staticmethod
+    def _serialize_block(dictionary, block_filename):
+        """
+        Sorts terms and writes a dictionary to a binary block file, one
+        length-prefixed msgpack (term, docnos, tfs) record per term with the
+        arrays stored as raw int32 bytes, plus a skip index of every
+        SKIP_INTERVAL-th record so merge workers can seek to a term range.
+        """
         print(f"Writing block {block_filename}...")
         
         # Sort terms
-        sorted_terms = sorted(self.dictionary.keys())
+        sorted_terms = sorted(dictionary.keys())
         
-        block_data = []
-        for term in sorted_terms:
-            block_data.append((term, self.dictionary[term]))
-            
-        with open(block_filename, 'wb') as f:
-            pickle.dump(block_data, f)
+        encoder = msgspec.msgpack.Encoder()
+        skips = []
+        offset = 0
+        with open(block_filename, 'wb', buffering=4 * 1024 * 1024) as f:
+            for i, term in enumerate(sorted_terms):
+                if i % SKIP_INTERVAL == 0:
+                    skips.append((term, offset))
+                docnos, tfs = dictionary[term]
+                record = encoder.encode((term, docnos.tobytes(), tfs.tobytes()))
+                f.write(struct.pack(">I", len(record)))
+                f.write(record)
+                offset += 4 + len(record)
+        with open(skip_index_path(block_filename), 'wb') as f:
+            f.write(encoder.encode(skips))
             
-        self.dictionary = defaultdict(dict)
-        self._estimated_size = 0
-        print(f"Finished writing block {self.block_count}.")
+        print(f"Finished writing block {block_filename}.")
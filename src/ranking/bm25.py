@@ -1,80 +1,219 @@
+import threading
 import numpy as np
 
+from src.ranking.bm25_numba import _score_term, _score_term_parallel, _score_postings
+
+# Posting lists at least this long are scored across threads; below it the
+# thread start-up costs more than the loop itself
+PARALLEL_MIN_POSTINGS = 1 << 16
+
+# Largest score accumulator kept between queries (4 MB of float32); broader
+# queries get a one-off array so a single huge query doesn't pin its size
+SCRATCH_SCORES_MAX = 1 << 20
+
+# Queries whose posting lists add up to less than this fraction of the
+# collection score into a compact accumulator over their union; broader ones
+# use a dense N-sized array, where the union's sort costs more than it saves
+COMPACT_UNION_MAX_FRACTION = 1 / 10
+
+def bm25_idf(N, df):
+    """BM25 idf for document frequency df (scalar or array) in a corpus of N docs."""
+    return np.log((N - df + 0.5) / (df + 0.5) + 1)
+
+def _top_k_results(scores, candidates, top_k, doc_ids=None, docnos=None):
+    """
+    Picks the top_k candidates by score and returns [(doc_id, score)].
+    O(n) partition, then only the K winners are sorted by descending score.
+    docnos maps positions in scores to docnos when scores is a compact
+    accumulator (scores are indexed by docno if None).
+    """
+    cand_scores = scores[candidates]
+    if 0 < top_k < len(candidates):
+        part = np.argpartition(cand_scores, -top_k)[-top_k:]
+        order = part[np.argsort(-cand_scores[part])]
+    else:
+        order = np.argsort(-cand_scores)[:top_k]
+    top_indices = candidates[order]
+    
+    results = []
+    for idx in top_indices:
+        docno = docnos[idx] if docnos is not None else idx
+        doc_id = int(doc_ids[docno]) if doc_ids is not None else int(docno)
+        results.append((doc_id, float(scores[idx])))
+        
+    return results
+
 class BM25Ranker:
-    def __init__(self, doc_lengths, avgdl, N, k1=1.5, b=0.75):
+    def __init__(self, doc_lengths, avgdl, N, doc_ids=None, k1=1.5, b=0.75):
         """
-        doc_lengths: dict or array of document lengths. {doc_id: length} or array indexed by int(doc_id)
+        doc_lengths: int32 array (may be a memmap) of document lengths indexed by docno
         avgdl: float, average document length
         N: int, total number of documents
+        doc_ids: int64 array mapping docno -> external doc_id (docno is returned if None)
         """
-        self.doc_lengths = doc_lengths 
+        self.doc_lengths = np.asarray(doc_lengths, dtype=np.int32)
+        self.doc_ids = doc_ids
         self.avgdl = avgdl
         self.N = N
         self.k1 = k1
         self.b = b
+        # Constants hoisted out of the per-posting expression:
+        # k1 * (1 - b + b * dl / avgdl) == c0 + c1 * dl
+        self.c0 = k1 * (1 - b)
+        self.c1 = k1 * b / avgdl if avgdl else 0.0
+        self.k1p1 = k1 + 1
+        # Per-doc length norm k1 * (1 - b + b * dl / avgdl), computed once for the corpus
+        self.doc_norms = (self.c0 + self.c1 * self.doc_lengths).astype(np.float32)
+        # Shortest document has the smallest norm, used for upper bounds
+        self.min_norm = float(self.doc_norms.min()) if len(self.doc_norms) else self.c0
+        # Score accumulator reused across queries, one per thread: the API ranks
+        # BM25 searches on the event loop thread and hybrid ones on threadpool
+        # workers, the console on its main thread.
+        self._local = threading.local()
+
+    def idf(self, df):
+        return bm25_idf(self.N, df)
+
+    def term_scores(self, doc_ids, tfs):
+        """BM25 contribution of one term to each document in its posting list."""
+        num_factor = np.float32(self.idf(len(doc_ids)) * self.k1p1)
+        tfs = tfs.astype(np.float32)
+        return num_factor * tfs / (tfs + self.doc_norms[doc_ids])
+
+    def _scratch_scores(self, n):
+        """Zeroed float32 view of length n over this thread's reusable buffer."""
+        if n > SCRATCH_SCORES_MAX:
+            return np.zeros(n, dtype=np.float32)
+        buf = getattr(self._local, 'scores', None)
+        if buf is None or len(buf) < n:
+            # Grow geometrically (up to the cap) so a slowly rising candidate
+            # count reallocates rarely
+            size = max(n, 2 * len(buf) if buf is not None else 1024)
+            buf = np.empty(min(size, SCRATCH_SCORES_MAX), dtype=np.float32)
+            self._local.scores = buf
+        scores = buf[:n]
+        scores.fill(0)
+        return scores
 
-    def rank(self, query_terms, candidate_postings, top_k=10):
+    def upper_bound(self, idf, max_tf):
+        """Largest score a term can contribute to any single document (MaxScore bound)."""
+        return idf * self.k1p1 * max_tf / (max_tf + self.min_norm)
+
+    def rank(self, query_terms, candidate_postings, top_k=10, max_tfs=None, idfs=None):
         """
         query_terms: list of terms in query (only for IDF calculation if needed, 
                      but postings already filtered by query terms?)
                      Actually usually we iterate over query terms.
-        candidate_postings: {term: {doc_id: tf}} for terms in query.
+        candidate_postings: {term: (docnos, tfs)} for terms in query, as
+                            returned by IndexReader.get_postings.
+        max_tfs: optional {term: max_tf} from the lexicon; computed from the
+                 postings when missing.
+        idfs: optional {term: idf} precomputed in the lexicon; computed from
+              the document frequency when missing.
         
         Returns: list of (doc_id, score) sorted by score.
         """
-        
-        # Identify all unique candidate docs
-        all_candidate_docs = set()
-        for term in candidate_postings:
-             all_candidate_docs.update(candidate_postings[term].keys())
-        
-        if not all_candidate_docs:
+        if not candidate_postings or top_k <= 0:
             return []
 
-        # Create a mapping from doc_id to index for vectorization
-        doc_ids = list(all_candidate_docs)
-        doc_to_idx = {d: i for i, d in enumerate(doc_ids)}
-        num_candidates = len(doc_ids)
-        
-        # Initialize scores
-        scores = np.zeros(num_candidates)
-        
-        # Convert doc_lengths to numpy array for efficient lookups
-        candidate_lens = np.array([self.doc_lengths.get(d, 0) for d in doc_ids])
-
+        terms = []
         for term in query_terms:
             if term not in candidate_postings:
                 continue
-                
-            postings = candidate_postings[term] # {doc_id: tf}
-            
-            # Document frequency
-            df = len(postings) 
-            # IDF calculation
-            idf = np.log((self.N - df + 0.5) / (df + 0.5) + 1)
-            
-            # Extract TFs for the candidate docs (aligned with doc_ids)
-            term_docs = list(postings.keys())
-            term_tfs = np.array(list(postings.values()))
-            
-            indices = [doc_to_idx[d] for d in term_docs]
-            
-            curr_lens = candidate_lens[indices]
+            doc_ids, tfs = candidate_postings[term]
             
-            # BM25 formula component
-            numerator = term_tfs * (self.k1 + 1)
-            denominator = term_tfs + self.k1 * (1 - self.b + self.b * (curr_lens / self.avgdl))
-            
-            term_scores = idf * (numerator / denominator)
-            
-            # Accumulate scores
-            scores[indices] += term_scores
+            # IDF from the lexicon, or from the document frequency
+            idf = idfs[term] if idfs and term in idfs else self.idf(len(doc_ids))
+            max_tf = max_tfs[term] if max_tfs and term in max_tfs else tfs.max()
+            # Scoring runs in float32 end to end: tfs are promoted in the kernels
+            # and the per-term factor is cast once here
+            terms.append((self.upper_bound(idf, max_tf), np.float32(idf * self.k1p1), doc_ids, tfs))
+        if not terms:
+            return []
+
+        n_docs = len(self.doc_norms)
+        if sum(len(t[2]) for t in terms) < COMPACT_UNION_MAX_FRACTION * n_docs:
+            # Compact accumulator over the docs matching any term: every posting
+            # list is remapped to (sorted) positions in their union in one call,
+            # so nothing below is O(N)
+            docnos, inverse = np.unique(np.concatenate([t[2] for t in terms]), return_inverse=True)
+            splits = np.cumsum([len(t[2]) for t in terms])[:-1]
+            terms = [(bound, num_factor, positions, tfs) for (bound, num_factor, _, tfs), positions in zip(terms, np.split(inverse, splits))]
+            scores = self._scratch_scores(len(docnos))
+            doc_norms = self.doc_norms[docnos]
+        else:
+            # Dense accumulator indexed by docno directly. Scoring a long list
+            # costs less here than MaxScore's O(N) threshold checks and
+            # candidate lookups, so every term is scored in full
+            docnos = None
+            scores = self._scratch_scores(n_docs)
+            doc_norms = self.doc_norms
+
+        # MaxScore: visit terms by decreasing upper bound. Once the current
+        # k-th best score reaches the sum of the remaining bounds, no unseen
+        # document can enter the top K, so the remaining (non-essential)
+        # terms are only scored for documents that are already candidates.
+        terms.sort(key=lambda t: t[0], reverse=True)
+        remaining = np.cumsum([t[0] for t in terms][::-1])[::-1]
+
+        candidates = None
+        essential = len(terms)
+        for i, (_, num_factor, positions, tfs) in enumerate(terms):
+            if i > 0 and docnos is not None:
+                seen = np.flatnonzero(scores)
+                if len(seen) >= top_k:
+                    threshold = np.partition(scores[seen], len(seen) - top_k)[len(seen) - top_k]
+                    if threshold >= remaining[i]:
+                        candidates = seen
+                        essential = i
+                        break
+
+            # BM25 formula component, fused into one compiled loop per term
+            score_term = _score_term_parallel if len(positions) >= PARALLEL_MIN_POSTINGS else _score_term
+            score_term(positions, tfs, doc_norms, num_factor, scores)
+
+        if candidates is None:
+            # Every document in the union matched at least one term
+            candidates = np.arange(len(docnos)) if docnos is not None else np.flatnonzero(scores)
+        else:
+            # Non-essential terms: look up the candidates in each (sorted)
+            # position list and score all hits together in one flat pass
+            hit_docs, hit_tfs, num_factors = [], [], []
+            for _, num_factor, positions, tfs in terms[essential:]:
+                pos = np.searchsorted(positions, candidates)
+                pos[pos == len(positions)] = 0
+                hit = positions[pos] == candidates
+                hit_docs.append(candidates[hit])
+                hit_tfs.append(tfs[pos[hit]])
+                num_factors.append(np.full(len(hit_docs[-1]), num_factor, dtype=np.float32))
+            _score_postings(
+                np.concatenate(hit_docs), np.concatenate(hit_tfs), np.concatenate(num_factors),
+                doc_norms, scores
+            )
+
+        return _top_k_results(scores, candidates, top_k, self.doc_ids, docnos)
+
+class EagerBM25Ranker:
+    def __init__(self, score_matrix, term_ids, doc_ids=None):
+        """
+        score_matrix: scipy CSR (terms x docs) of precomputed BM25 posting scores,
+                      built by merging.build_score_matrix
+        term_ids: term -> matrix row mapping (the index's lexicon trie)
+        doc_ids: int64 array mapping docno -> external doc_id (docno is returned if None)
+        """
+        self.score_matrix = score_matrix
+        self.term_ids = term_ids
+        self.doc_ids = doc_ids
+
+    def rank(self, query_terms, top_k=10):
+        """
+        Sums the query terms' precomputed score rows; no BM25 math at query time.
+        Returns: list of (doc_id, score) sorted by score.
+        """
+        rows = [self.term_ids[term] for term in query_terms if term in self.term_ids]
+        if not rows or top_k <= 0:
+            return []
+
+        scores = np.asarray(self.score_matrix[rows].sum(axis=0)).ravel()
+        return _top_k_results(scores, np.flatnonzero(scores), top_k, self.doc_ids)
 
-        # Get top K and sort by descending
-        top_indices = np.argsort(scores)[::-1][:top_k]
-        
-        results = []
-        for idx in top_indices:
-            results.append((doc_ids[idx], scores[idx]))
-            
-        return results
@@ -0,0 +1,41 @@
+import numba
+import numpy as np
+
+
+@numba.njit(cache=True, fastmath=True)
+def _score_term(doc_ids, tfs, norms, num_factor, scores):
+    """
+    Adds one term's BM25 contribution for every posting into scores.
+    doc_ids/tfs: the term's postings (tfs as stored, e.g. uint8),
+    norms: per-doc length norm k1 * (1 - b + b * dl / avgdl),
+    num_factor: idf * (k1 + 1),
+    scores: float32 accumulator indexed like norms (updated in place).
+    """
+    for i in range(doc_ids.shape[0]):
+        d = doc_ids[i]
+        tf = np.float32(tfs[i])
+        scores[d] += num_factor * tf / (tf + norms[d])
+
+
+@numba.njit(cache=True, fastmath=True)
+def _score_postings(doc_ids, tfs, num_factors, norms, scores):
+    """
+    Same as _score_term for postings of several terms concatenated into
+    flat arrays; num_factors carries each posting's idf * (k1 + 1).
+    """
+    for i in range(doc_ids.shape[0]):
+        d = doc_ids[i]
+        tf = np.float32(tfs[i])
+        scores[d] += num_factors[i] * tf / (tf + norms[d])
+
+
+@numba.njit(cache=True, fastmath=True, parallel=True)
+def _score_term_parallel(doc_ids, tfs, norms, num_factor, scores):
+    """
+    _score_term split across threads. A posting list holds each docno once,
+    so the iterations update distinct scores entries and need no atomics.
+    """
+    for i in numba.prange(doc_ids.shape[0]):
+        d = doc_ids[i]
+        tf = np.float32(tfs[i])
+        scores[d] += num_factor * tf / (tf + norms[d])
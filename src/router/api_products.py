@@ -1,10 +1,11 @@
-from fastapi import APIRouter, HTTPException
+from itertools import islice
+from fastapi import APIRouter, HTTPException, Request
 from src.router import deps
 
 router = APIRouter()
 
 @router.get("/products")
-async def get_ui_products(limit: int = 50):
+def get_ui_products(request: Request, limit: int = 50):
     """Fetch all products for landing page."""
     if deps.db_pool:
         try:
@@ -23,16 +24,16 @@ async def get_ui_products(limit: int = 50):
                         "id": str(r[0]), "name": r[1], "price": r[2], 
                         "external_url": r[3], "image_url": r[4], "platform": r[5]
                     })
-                return {"success": True, "data": data, "count": len(data)}
+                return deps.etag_response(request, {"success": True, "data": data, "count": len(data)})
         except Exception as e:
             print(f"[get_ui_products] DB error: {e}")
 
     # Fallback to local sample
-    data = list(deps.local_product_db.values())[:limit]
-    return {"success": True, "data": data, "count": len(data)}
+    data = list(islice(deps.local_product_db.iter_products(), limit))
+    return deps.etag_response(request, {"success": True, "data": data, "count": len(data)})
 
 @router.get("/products/{product_id}")
-async def get_product_detail(product_id: str):
+def get_product_detail(product_id: str):
     """Fetch full product details by ID."""
     if deps.db_pool:
         try:
@@ -48,7 +49,7 @@ async def get_product_detail(product_id: str):
                 """, (product_id,))
                 r = cur.fetchone()
                 if r:
-                    return {
+                    return deps.json_response({
                         "success": True,
                         "data": {
                             "id": str(r[0]), "name": r[1], "price": r[2], 
@@ -59,12 +60,12 @@ async def get_product_detail(product_id: str):
                             "sold_count": r[11], "available": r[12],
                             "original_price": r[13], "discount_percent": r[14]
                         }
-                    }
+                    })
         except Exception as e:
             deps.logger.error(f"get_product_detail DB error: {e}", exc_info=True)
 
     # Fallback to local sample
     if product_id in deps.local_product_db:
-        return {"success": True, "data": deps.local_product_db[product_id]}
+        return deps.json_response({"success": True, "data": deps.local_product_db[product_id]})
         
     raise HTTPException(status_code=404, detail="Product not found")
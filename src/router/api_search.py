@@ -1,9 +1,11 @@
 import time
+import asyncio
+import logging
 from fastapi import APIRouter, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from typing import List, Optional, Tuple, Dict, Any
-from pyvi import ViTokenizer
-
+from src.crawler.parser import tokenize_query
 from src.router import deps
 
 router = APIRouter()
@@ -29,9 +31,7 @@ class SearchResponse(BaseModel):
 def smart_search_fallback(query: str, limit: int = 50, platforms: List[str] = None, min_price: float = None, max_price: float = None):
     query_lower = query.lower()
     results = []
-    for item in deps.local_product_db.values():
-        if query_lower not in (item.get("name") or "").lower():
-            continue
+    for item in deps.local_product_db.search_names(query_lower):
         if platforms and item.get("platform") not in platforms:
             continue
         try:
@@ -58,33 +58,24 @@ def smart_search_fallback(query: str, limit: int = 50, platforms: List[str] = No
         "fallback": True
     }
 
-@router.post("/search/bm25", response_model=SearchResponse)
-async def search_bm25(request: SearchRequest):
-    start_time = time.time()
-    
-    if not deps.bm25_ranker or not deps.index_reader:
-        raise HTTPException(status_code=503, detail="Search engine not initialized")
-        
-    query_tokens = ViTokenizer.tokenize(request.query.lower()).split()
-    
-    candidate_postings = {}
-    for token in query_tokens:
-        postings = deps.index_reader.get_postings(token)
-        if postings:
-            candidate_postings[token] = postings
-            
-    results = deps.bm25_ranker.rank(query_tokens, candidate_postings, top_k=request.top_k)
-    
-    doc_ids = [doc_id for doc_id, _ in results]
-    product_info = deps.get_products(
-        doc_ids, 
+async def _build_results(scored, request: SearchRequest) -> Tuple[List[SearchResultItem], Dict[str, Dict]]:
+    """
+    Fetches product rows for scored (doc_id, score) pairs in one query, applying
+    the request filters. The rows are returned with the items so callers that
+    need full product data don't have to query them a second time.
+    """
+    doc_ids = [doc_id for doc_id, _ in scored]
+    # psycopg2 blocks; run the query on the threadpool so the event loop stays free
+    product_info = await run_in_threadpool(
+        deps.get_products,
+        doc_ids,
         platforms=request.platforms, 
         min_price=request.min_price, 
         max_price=request.max_price
     )
 
     response_items = []
-    for doc_id, score in results:
+    for doc_id, score in scored:
         info = product_info.get(str(doc_id))
         if info:
             response_items.append(SearchResultItem(
@@ -93,58 +84,42 @@ async def search_bm25(request: SearchRequest):
                 name=info.get("name"),
                 price=info.get("price")
             ))
+    return response_items, product_info
 
-    return SearchResponse(results=response_items, time_taken=time.time() - start_time)
+async def _run_bm25(request: SearchRequest):
+    if not deps.bm25_ranker or not deps.index_reader:
+        raise HTTPException(status_code=503, detail="Search engine not initialized")
+        
+    query_tokens = tokenize_query(request.query.lower())
+    candidate_postings, max_tfs, idfs = deps.index_reader.get_query_postings(query_tokens)
+    results = deps.bm25_ranker.rank(query_tokens, candidate_postings, top_k=request.top_k, max_tfs=max_tfs, idfs=idfs)
+    return await _build_results(results, request)
 
-@router.post("/search/vector", response_model=SearchResponse)
-async def search_vector(request: SearchRequest):
-    start_time = time.time()
-    
+async def _run_vector(request: SearchRequest):
     if not deps.vector_ranker:
         raise HTTPException(status_code=503, detail="Vector search not initialized")
         
-    results = deps.vector_ranker.search(request.query, top_k=request.top_k)
-    
-    doc_ids = [res['id'] for res in results]
-    product_info = deps.get_products(
-        doc_ids, 
-        platforms=request.platforms, 
-        min_price=request.min_price, 
-        max_price=request.max_price
-    )
-
-    response_items = []
-    for res in results:
-        info = product_info.get(str(res['id']))
-        if info:
-            response_items.append(SearchResultItem(
-                id=str(res['id']),
-                score=res['score'],
-                name=info.get("name"),
-                price=info.get("price")
-            ))
+    results = await run_in_threadpool(deps.vector_ranker.search, request.query, top_k=request.top_k)
+    return await _build_results([(res['id'], res['score']) for res in results], request)
 
-    return SearchResponse(results=response_items, time_taken=time.time() - start_time)
-
-@router.post("/search/hybrid", response_model=SearchResponse)
-async def search_hybrid(request: SearchRequest):
-    start_time = time.time()
-    
+async def _run_hybrid(request: SearchRequest):
     if not deps.vector_ranker or not deps.bm25_ranker:
         raise HTTPException(status_code=503, detail="Search engines not initialized")
 
-    vec_results = deps.vector_ranker.search(request.query, top_k=request.top_k * 2) 
-    vec_scores = {res['id']: res['score'] for res in vec_results}
-    
-    query_tokens = ViTokenizer.tokenize(request.query.lower()).split()
-    candidate_postings = {}
-    for token in query_tokens:
-        postings = deps.index_reader.get_postings(token)
-        if postings:
-            candidate_postings[token] = postings
-            
-    bm25_raw = deps.bm25_ranker.rank(query_tokens, candidate_postings, top_k=request.top_k * 2)
+    def rank_bm25():
+        query_tokens = tokenize_query(request.query.lower())
+        candidate_postings, max_tfs, idfs = deps.index_reader.get_query_postings(query_tokens)
+        return deps.bm25_ranker.rank(query_tokens, candidate_postings, top_k=request.top_k * 2, max_tfs=max_tfs, idfs=idfs)
+
+    # Vector search (embedding + Qdrant round-trip) and BM25 ranking run side
+    # by side on the threadpool. gather retrieves both outcomes, so if one
+    # raises the other's result or error is not left dangling.
+    vec_results, bm25_raw = await asyncio.gather(
+        run_in_threadpool(deps.vector_ranker.search, request.query, request.top_k * 2),
+        run_in_threadpool(rank_bm25),
+    )
     bm25_scores = {doc_id: score for doc_id, score in bm25_raw}
+    vec_scores = {res['id']: res['score'] for res in vec_results}
     
     all_ids = set(vec_scores.keys()) | set(bm25_scores.keys())
     
@@ -158,7 +133,7 @@ async def search_hybrid(request: SearchRequest):
     vec_norm = normalize(vec_scores)
     bm25_norm = normalize(bm25_scores)
     
-    final_scores: List[Tuple[str, float]] = []
+    final_scores: List[Tuple[int, float]] = []
     for doc_id in all_ids:
         v_s = vec_norm.get(doc_id, 0.0)
         b_s = bm25_norm.get(doc_id, 0.0)
@@ -167,26 +142,24 @@ async def search_hybrid(request: SearchRequest):
         
     final_scores.sort(key=lambda x: x[1], reverse=True)
     top_results = list(final_scores)[:int(request.top_k)]
-    
-    doc_ids = [doc_id for doc_id, _ in top_results]
-    product_info = deps.get_products(
-        doc_ids, 
-        platforms=request.platforms, 
-        min_price=request.min_price, 
-        max_price=request.max_price
-    )
+    return await _build_results(top_results, request)
 
-    response_items = []
-    for doc_id, score in top_results:
-        info = product_info.get(str(doc_id))
-        if info:
-            response_items.append(SearchResultItem(
-                id=str(doc_id),
-                score=score,
-                name=info.get("name"),
-                price=info.get("price")
-            ))
+@router.post("/search/bm25", response_model=SearchResponse)
+async def search_bm25(request: SearchRequest):
+    start_time = time.time()
+    response_items, _ = await _run_bm25(request)
+    return SearchResponse(results=response_items, time_taken=time.time() - start_time)
+
+@router.post("/search/vector", response_model=SearchResponse)
+async def search_vector(request: SearchRequest):
+    start_time = time.time()
+    response_items, _ = await _run_vector(request)
+    return SearchResponse(results=response_items, time_taken=time.time() - start_time)
 
+@router.post("/search/hybrid", response_model=SearchResponse)
+async def search_hybrid(request: SearchRequest):
+    start_time = time.time()
+    response_items, _ = await _run_hybrid(request)
     return SearchResponse(results=response_items, time_taken=time.time() - start_time)
 
 @router.get("/search")
@@ -200,32 +173,49 @@ async def ui_search(
     max_price: Optional[float] = None
 ):
     start_time = time.time()
+    # The key and the computation use the same query string, so a cached
+    # body is exactly what this request would have produced
+    query = query.strip()
+    key = (query, limit, method, alpha, platforms, min_price, max_price)
+    result = await deps.search_cache.get_or_compute(
+        key, lambda: _ui_search(query, limit, method, alpha, platforms, min_price, max_price),
+        cacheable=_is_cacheable_search
+    )
+    if "time_taken" in result:
+        result = {**result, "time_taken": time.time() - start_time}
+    return deps.json_response(result)
+
+def _is_cacheable_search(result: Dict[str, Any]) -> bool:
+    # Sample-data fallbacks (engines down or an error) and empty results,
+    # which is also what a failed product lookup yields, are not cached
+    return not result.get("fallback") and result.get("count", 0) > 0
+
+async def _ui_search(query: str, limit: int, method: str, alpha: float,
+                     platforms: Optional[str], min_price: Optional[float], max_price: Optional[float]):
+    start_time = time.time()
     try:
         platform_list = [p.strip() for p in platforms.split(",")] if platforms else None
         effective_limit = limit * 20 if (platforms or min_price or max_price) else limit
         if effective_limit > 1000: effective_limit = 1000 
 
         data = []
-        deps.logger.info(f"ui_search: method={method}, query='{query}', vr={deps.vector_ranker is not None}, bm25={deps.bm25_ranker is not None}")
+        if deps.logger.isEnabledFor(logging.DEBUG):
+            deps.logger.debug(f"ui_search: method={method}, query='{query}', vr={deps.vector_ranker is not None}, bm25={deps.bm25_ranker is not None}")
         
         req = SearchRequest(query=query, top_k=effective_limit, platforms=platform_list, min_price=min_price, max_price=max_price)
         if method == "bm25" and deps.bm25_ranker:
-            res = await search_bm25(req)
-            data = res.results
+            data, db_product_info = await _run_bm25(req)
         elif method == "vector" and deps.vector_ranker:
-            res = await search_vector(req)
-            data = res.results
+            data, db_product_info = await _run_vector(req)
         elif method == "hybrid" and deps.vector_ranker and deps.bm25_ranker:
             req.alpha = alpha
-            res = await search_hybrid(req)
-            data = res.results
+            data, db_product_info = await _run_hybrid(req)
         else:
             deps.logger.warning(f"Falling back to smart_search_fallback. VR: {deps.vector_ranker is not None}, BM25: {deps.bm25_ranker is not None}")
             return smart_search_fallback(query, limit, platforms=platform_list, min_price=min_price, max_price=max_price)
             
+        # Rows were already fetched with the ranking results; no second round-trip
         data = data[:limit]
-        doc_ids = [item.id for item in data]
-        db_product_info = deps.get_products(doc_ids)
         
         full_data = []
         for item in data:
@@ -242,6 +232,7 @@ async def ui_search(
             if item.price: product["price"] = item.price
             full_data.append(product)
 
+        deps.logger.info("ui_search: method=%s, query='%s', hits=%d", method, query, len(full_data))
         return {
             "success": True,
             "data": full_data,
@@ -1,34 +1,41 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Request
+from fastapi.concurrency import run_in_threadpool
 from src.router import deps
 
 router = APIRouter()
 
 @router.get("/stats")
-async def get_ui_stats():
+async def get_ui_stats(request: Request):
     """Get statistics for dashboard from the real database."""
+    # psycopg2 blocks, so the queries run on the threadpool, not the event loop
+    # Only DB-backed stats are cached; the local-sample fallback is not
+    stats = await deps.stats_cache.get_or_compute(
+        "stats", lambda: run_in_threadpool(_compute_stats), cacheable=lambda s: s.get("success", False)
+    )
+    return deps.etag_response(request, stats)
+
+def _compute_stats():
     if deps.db_pool:
         try:
             with deps.get_db_cursor() as cur:
-                # 1. Total products
-                cur.execute("SELECT COUNT(*) FROM raw_products")
-                total_products = cur.fetchone()[0]
-                
-                # 2. Platform distribution (joining with sources)
+                # Product total, brand total and the platform distribution
+                # (sources joined with products) in a single round-trip
                 cur.execute("""
-                    SELECT s.name, COUNT(p.id) 
-                    FROM sources s
-                    LEFT JOIN raw_products p ON s.id = p.source_id
-                    GROUP BY s.name
-                    ORDER BY COUNT(p.id) DESC
+                    WITH platforms AS (
+                        SELECT s.name, COUNT(p.id) AS count
+                        FROM sources s
+                        LEFT JOIN raw_products p ON s.id = p.source_id
+                        GROUP BY s.name
+                    )
+                    SELECT
+                        (SELECT COUNT(*) FROM raw_products),
+                        (SELECT COUNT(*) FROM brands),
+                        (SELECT COALESCE(json_agg(json_build_object('name', name, 'count', count) ORDER BY count DESC), '[]')
+                         FROM platforms)
                 """)
-                platform_rows = cur.fetchall()
-                platform_distribution = [{"name": r[0], "count": r[1]} for r in platform_rows]
-                
-                # 3. Total brands
-                cur.execute("SELECT COUNT(*) FROM brands")
-                total_brands = cur.fetchone()[0]
+                total_products, total_brands, platform_distribution = cur.fetchone()
                 
-                # 4. Total platforms (active)
+                # Total platforms (active)
                 total_platforms = len([p for p in platform_distribution if p['count'] > 0])
                 
                 return {
@@ -44,7 +51,7 @@ async def get_ui_stats():
 
     # Fallback to local sample JSONL if DB fails
     platforms = {}
-    for item in deps.local_product_db.values():
+    for item in deps.local_product_db.iter_products():
         plat = item.get("platform", "unknown")
         platforms[plat] = platforms.get(plat, 0) + 1
         
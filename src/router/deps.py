@@ -1,41 +1,143 @@
+import asyncio
+import functools
+import hashlib
 import logging
+import mmap
+import re
+import threading
+import time
+from array import array
+from collections import OrderedDict
+import orjson
 from pathlib import Path
-from typing import Dict, Any, List, Optional
-from fastapi import HTTPException
+from typing import Dict, Any, Awaitable, Callable, Hashable, List, Mapping, Optional, Tuple
+import numpy as np
+from fastapi import HTTPException, Request, Response
+from fastapi.encoders import decimal_encoder
 from contextlib import contextmanager
 
 # Logging setup
 LOG_FILE = Path(__file__).resolve().parent.parent.parent / "logs" / "api.log"
-LOG_FILE.parent.mkdir(exist_ok=True)
-logging.basicConfig(
-    filename=str(LOG_FILE),
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
 logger = logging.getLogger("api")
 
+@functools.cache
+def configure_logging():
+    """Sends API logs to LOG_FILE. Called at app startup, not on import."""
+    LOG_FILE.parent.mkdir(exist_ok=True)
+    logging.basicConfig(
+        filename=str(LOG_FILE),
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+SAMPLE_FILE = Path(__file__).resolve().parent.parent.parent / "data_sample" / "sample.jsonl"
+
 # Globals injected by app.py
 bm25_ranker = None
 index_reader = None
 vector_ranker = None
 db_pool = None
 
+# ThreadedConnectionPool raises PoolError instead of waiting when all maxconn
+# connections are out, and the threadpool running DB calls is larger than
+# the pool, so callers wait for a slot here first
+DB_MAX_CONNECTIONS = 20
+db_slots = threading.BoundedSemaphore(DB_MAX_CONNECTIONS)
+
 @contextmanager
 def get_db_cursor():
     """Context manager for getting a database cursor from the pool."""
     if db_pool is None:
         raise HTTPException(status_code=500, detail="Database pool not initialized")
     
-    conn = db_pool.getconn()
-    try:
-        with conn.cursor() as cur:
-            yield cur
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        raise e
-    finally:
-        db_pool.putconn(conn)
+    with db_slots:
+        conn = db_pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                yield cur
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            raise e
+        finally:
+            db_pool.putconn(conn)
+
+class ResultCache:
+    """
+    In-memory TTL + LRU cache for endpoint results, local to each worker
+    process. Concurrent misses on the same key share a single computation
+    instead of each hitting the DB; results failing `cacheable` are handed
+    to those callers but not stored.
+    """
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+
+    async def get_or_compute(self, key: Hashable, compute: Callable[[], Awaitable[Any]],
+                             cacheable: Optional[Callable[[Any], bool]] = None) -> Any:
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                return entry[1]
+            del self._entries[key]
+
+        pending = self._inflight.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await compute()
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # mark retrieved when nobody else was waiting
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+        future.set_result(result)
+        if cacheable is None or cacheable(result):
+            self._entries[key] = (time.monotonic() + self.ttl, result)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return result
+
+def _encode_json(content: Any) -> bytes:
+    # orjson handles everything but the DB's Decimal prices natively;
+    # decimal_encoder turns those into numbers the way FastAPI does
+    return orjson.dumps(content, default=decimal_encoder)
+
+def json_response(content: Any) -> Response:
+    """
+    Encodes an untyped dict response with orjson. Routes with a response
+    model are left to FastAPI, which serializes those with pydantic.
+    """
+    return Response(content=_encode_json(content), media_type="application/json")
+
+def etag_response(request: Request, content: Any) -> Response:
+    """
+    JSON response with a weak ETag over the body; answers 304 with no body
+    when the client's If-None-Match already names it.
+    """
+    body = _encode_json(content)
+    etag = f'W/"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+SEARCH_CACHE_TTL = 60
+STATS_CACHE_TTL = 300  # aggregates drift slowly
+
+search_cache = ResultCache(maxsize=1024, ttl=SEARCH_CACHE_TTL)
+stats_cache = ResultCache(maxsize=1, ttl=STATS_CACHE_TTL)
 
 PLATFORM_URL_PATTERNS = {
     "shopee": ["shopee.vn", "shopee.com"],
@@ -54,38 +156,140 @@ PLATFORM_URL_PATTERNS = {
     "fahasa": ["fahasa.com"],
 }
 
+# One alternation with a named group per platform; lastgroup names the match
+PLATFORM_URL_RE = re.compile("|".join(
+    f"(?P<{platform}>{'|'.join(re.escape(pattern.lower()) for pattern in patterns)})"
+    for platform, patterns in PLATFORM_URL_PATTERNS.items()
+))
+
+def _match_platform(text: str) -> Optional[str]:
+    match = PLATFORM_URL_RE.search(text)
+    return match.lastgroup if match else None
+
+# Keyed on scheme + host, so products of one shop share an entry
+_detect_platform_by_host = functools.lru_cache(maxsize=4096)(_match_platform)
+
 def detect_platform_from_url(url: str) -> Optional[str]:
     if not url: return None
-    url_lower = url.lower()
-    for platform, patterns in PLATFORM_URL_PATTERNS.items():
-        for pattern in patterns:
-            if pattern in url_lower:
-                return platform
-    return None
+    # The patterns are all domains, so a hit in the host is the leftmost
+    # match in the whole URL; only URLs whose host matches nothing (e.g. a
+    # redirect carrying the shop URL in its query) are scanned in full
+    host = "/".join(url.split("/", 3)[:3])
+    platform = _detect_platform_by_host(host.lower())
+    if platform is None and len(host) < len(url):
+        platform = _match_platform(url.lower())
+    return platform
+
+UNKNOWN_PLATFORMS = frozenset({"unknown", "null", "none", ""})
+
+PLATFORM_ALIASES = {
+    "dien may xanh": "dienmayxanh",
+    "điện máy xanh": "dienmayxanh",
+    "the gioi di dong": "thegioididong",
+    "thế giới di động": "thegioididong",
+    "cell phones": "cellphones",
+}
 
 def normalize_product_data(item: Dict[str, Any]) -> Dict[str, Any]:
     platform = item.get("platform") or item.get("source") or item.get("shop_name")
-    if not platform or platform.lower() in ["unknown", "null", "none", ""]:
+    if not platform or platform.lower() in UNKNOWN_PLATFORMS:
         url = item.get("url") or item.get("external_url") or item.get("product_url") or item.get("link")
         detected = detect_platform_from_url(url)
         if detected: platform = detected
     
     if platform:
         platform = str(platform).strip().lower()
-        platform_map = {
-            "dien may xanh": "dienmayxanh",
-            "điện máy xanh": "dienmayxanh",
-            "the gioi di dong": "thegioididong",
-            "thế giới di động": "thegioididong",
-            "cell phones": "cellphones",
-        }
-        platform = platform_map.get(platform, platform)
+        platform = PLATFORM_ALIASES.get(platform, platform)
     else:
         platform = "unknown"
     
     item["platform"] = platform
     return item
 
+class LocalProductStore(Mapping):
+    """
+    Read-only {id: product} view over the sample JSONL. Only a sorted
+    (id, line offset) index and the lowercased names are kept in RAM; a
+    product line is parsed from the mmap when it is looked up. Iteration
+    follows file order. A missing or empty file gives an empty store.
+    """
+    def __init__(self, path: Optional[Path] = None):
+        self._file = None
+        self._mm = None
+        ids, offsets, names = array('q'), array('q'), []
+        if path is not None and path.exists() and path.stat().st_size > 0:
+            self._file = open(path, 'rb')
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            offset = 0
+            for line in iter(self._mm.readline, b''):
+                if line.strip():
+                    try:
+                        item = orjson.loads(line)
+                        ids.append(int(item["id"]))
+                        offsets.append(offset)
+                        names.append((item.get("name") or "").lower().replace("\n", " "))
+                    except (orjson.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+                        logger.warning(f"Skipping malformed line in {path.name}: {e}")
+                offset += len(line)
+        self._ids = np.frombuffer(ids, dtype=np.int64)
+        self._offsets = np.frombuffer(offsets, dtype=np.int64)
+        self._order = np.argsort(self._ids, kind="stable")
+        self._sorted_ids = self._ids[self._order]
+        # All names in one newline-separated string, searched with str.find
+        self._names = "\n".join(names)
+        self._name_starts = np.cumsum([0] + [len(name) + 1 for name in names])
+
+    def _load(self, offset: int) -> Dict[str, Any]:
+        end = self._mm.find(b'\n', offset)
+        item = orjson.loads(self._mm[offset:end if end != -1 else len(self._mm)])
+        item["id"] = str(item.get("id"))
+        return normalize_product_data(item)
+
+    def _find(self, key) -> Optional[int]:
+        """File-order index of the product with this id, or None."""
+        try:
+            doc_id = int(key)
+            pos = int(np.searchsorted(self._sorted_ids, doc_id))
+        except (TypeError, ValueError, OverflowError):
+            return None
+        if pos == len(self._sorted_ids) or self._sorted_ids[pos] != doc_id:
+            return None
+        return int(self._order[pos])
+
+    def __getitem__(self, key) -> Dict[str, Any]:
+        i = self._find(key)
+        if i is None:
+            raise KeyError(key)
+        return self._load(int(self._offsets[i]))
+
+    def __contains__(self, key) -> bool:
+        # Index lookup only; the inherited version would parse the line
+        return self._find(key) is not None
+
+    def __iter__(self):
+        return (str(doc_id) for doc_id in self._ids)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def iter_products(self):
+        """Lazily parses every product in file order (one straight scan, no key lookups)."""
+        return (self._load(int(offset)) for offset in self._offsets)
+
+    def search_names(self, text: str):
+        """Yields, in file order, the products whose lowercased name contains text."""
+        if not text or "\n" in text:
+            return
+        pos = self._names.find(text)
+        while pos != -1:
+            i = int(np.searchsorted(self._name_starts, pos, side="right")) - 1
+            yield self._load(int(self._offsets[i]))
+            pos = self._names.find(text, int(self._name_starts[i + 1]))
+
+def load_local_products(path: Path = SAMPLE_FILE) -> LocalProductStore:
+    """Opens the sample JSONL as a lazily parsed {id: product} mapping."""
+    return LocalProductStore(path)
+
 def get_products(doc_ids: list, platforms: List[str] = None, min_price: float = None, max_price: float = None) -> Dict[Any, Dict]:
     if not db_pool or not doc_ids:
         return {}
@@ -97,11 +301,13 @@ def get_products(doc_ids: list, platforms: List[str] = None, min_price: float =
             
         if not clean_ids: return {}
 
+        # Only the fields result cards use; description, specs and the image
+        # gallery are loaded per product by /products/{id}
         query = """SELECT p.id, p.name, p.price, s.name as platform, 
-                          p.image_url, p.external_url, p.images, 
+                          p.image_url, p.external_url,
                           p.rating, p.review_count, p.sold_count,
                           p.original_price, p.discount_percent,
-                          p.description, p.available
+                          p.available
                    FROM raw_products p 
                    LEFT JOIN sources s ON p.source_id = s.id 
                    WHERE p.id = ANY(%s)"""
@@ -126,7 +332,8 @@ def get_products(doc_ids: list, platforms: List[str] = None, min_price: float =
             query += " AND p.price <= %s"
             params.append(float(max_price))
             
-        logger.info(f"Executing Query: {query} with params count {len(params)}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Executing Query: {query} with params count {len(params)}")
         try:
             with get_db_cursor() as cur:
                 cur.execute(query, tuple(params))
@@ -143,16 +350,17 @@ def get_products(doc_ids: list, platforms: List[str] = None, min_price: float =
                 "platform": row[3],
                 "image_url": row[4],
                 "external_url": row[5],
-                "images": row[6] or [],
-                "rating": row[7],
-                "review_count": row[8] or 0,
-                "sold_count": row[9] or 0,
-                "original_price": row[10],
-                "discount_percent": row[11],
-                "description": row[12],
-                "available": row[13] if row[13] is not None else True
+                "rating": row[6],
+                "review_count": row[7] or 0,
+                "sold_count": row[8] or 0,
+                "original_price": row[9],
+                "discount_percent": row[10],
+                "available": row[11] if row[11] is not None else True
             }
         return result
     except Exception as e:
         logger.error(f"get_products DB error: {e}", exc_info=True)
         return {}
+
+# Fallback when the DB is unreachable; replaced by app.py at startup
+local_product_db: LocalProductStore = LocalProductStore()
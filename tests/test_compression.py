@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from src.indexer.compression import BLOCK_SIZE, encode_doc_ids, decode_doc_ids
+
+def _round_trip(doc_ids):
+    doc_ids = np.asarray(doc_ids, dtype=np.int32)
+    decoded = decode_doc_ids(encode_doc_ids(doc_ids), len(doc_ids))
+    assert decoded.dtype == np.int32
+    np.testing.assert_array_equal(decoded, doc_ids)
+
+@pytest.mark.parametrize("count", [0, 1, BLOCK_SIZE - 1, BLOCK_SIZE, BLOCK_SIZE + 1, 5 * BLOCK_SIZE + 37])
+def test_round_trip_block_boundaries(count):
+    rng = np.random.default_rng(count)
+    _round_trip(np.sort(rng.choice(50 * max(count, 1), size=count, replace=False)))
+
+def test_round_trip_width_zero_blocks():
+    # Only docno 0 gives a zero delta; a block holding just it packs to 0 bits
+    _round_trip([0])
+    _round_trip([0, 1, 2, 3])
+    # A full block of zero deltas, followed by a partial one
+    _round_trip(np.zeros(BLOCK_SIZE + 3, dtype=np.int32))
+
+def test_round_trip_mixed_widths_with_partial_last_block():
+    dense = np.arange(3 * BLOCK_SIZE)                                   # width 1
+    sparse = dense[-1] + 1 + np.arange(2 * BLOCK_SIZE) * 100_000         # width 17
+    tail = sparse[-1] + 1 + np.arange(BLOCK_SIZE // 2) * 7               # partial block
+    _round_trip(np.concatenate([dense, sparse, tail]))
+
+def test_round_trip_large_docnos():
+    _round_trip([5, 2**31 - 2, 2**31 - 1])